@@ -22,9 +22,15 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One client per process; its pool is shared by every request thread
+    _client = MongoClient(database_url, maxPoolSize=50, minPoolSize=5)
     db = _client[database_name]
 
+def close_connection():
+    """Close the shared MongoDB client and its connection pool"""
+    if _client is not None:
+        _client.close()
+
 # Helper functions for common database operations
 def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
@@ -37,8 +43,9 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
     result = db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
@@ -1,17 +1,107 @@
 import os
+import asyncio
+import logging
 import secrets
 import hashlib
+import hmac
+from dataclasses import dataclass
+from collections import Counter
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone
-from typing import Optional, List
+from typing import Annotated, Optional, List
 
 from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr
-from bson.objectid import ObjectId
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, StringConstraints
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
 
-from database import db, create_document, get_documents
+from database import db, create_document, get_documents, close_connection
 
-app = FastAPI(title="Nexus Explorer API")
+logger = logging.getLogger(__name__)
+
+# Read once; database.py has already loaded .env by this point
+HAS_DATABASE_URL = bool(os.getenv("DATABASE_URL"))
+HAS_DATABASE_NAME = bool(os.getenv("DATABASE_NAME"))
+
+
+# ------------------------
+# Startup & shutdown
+# ------------------------
+
+def ensure_indexes():
+    # create_index is a no-op when an identical index already exists
+    db["user"].create_index("email", unique=True)
+    db["user"].create_index("username", unique=True)
+    db["session"].create_index("token", unique=True)
+    db["session"].create_index("user_id")
+    db["apikey"].create_index("key", unique=True)
+    # Also serves plain user_id lookups through its prefix
+    db["apikey"].create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+
+
+INDEX_RETRY_INTERVAL = 5.0
+# register/update_me rely on the unique indexes, so they are refused until set
+_indexes_ready = False
+
+
+async def create_indexes():
+    # Runs in the background so the app boots (and /test can report problems)
+    # while Mongo is unreachable; retries until the indexes exist
+    global _indexes_ready
+    while True:
+        try:
+            await run_in_threadpool(ensure_indexes)
+        except DuplicateKeyError as e:
+            logger.error(
+                "Could not create a unique index because existing documents collide (%s). "
+                "Remove the duplicate users/API keys and restart; registration and "
+                "profile updates stay disabled until then.",
+                (e.details or {}).get("errmsg", e),
+            )
+            return
+        except PyMongoError as e:
+            logger.warning("Could not create MongoDB indexes, retrying in %ss: %s", INDEX_RETRY_INTERVAL, e)
+            await asyncio.sleep(INDEX_RETRY_INTERVAL)
+        else:
+            _indexes_ready = True
+            return
+
+
+def require_unique_indexes():
+    if not _indexes_ready:
+        raise HTTPException(status_code=503, detail="Database is not ready, try again later")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    index_builder = usage_flusher = None
+    stop_flushing = asyncio.Event()
+    if db is not None:
+        index_builder = asyncio.create_task(create_indexes())
+        usage_flusher = asyncio.create_task(flush_usage_until(stop_flushing))
+    try:
+        yield
+    finally:
+        if index_builder is not None:
+            index_builder.cancel()
+            with suppress(asyncio.CancelledError):
+                await index_builder
+        if usage_flusher is not None:
+            # The flusher finishes any in-flight write, flushes once more and exits
+            stop_flushing.set()
+            await usage_flusher
+        # Close the client only once buffered usage has been written
+        await run_in_threadpool(close_connection)
+
+
+app = FastAPI(title="Nexus Explorer API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,38 +116,122 @@ app.add_middleware(
 # Utility helpers
 # ------------------------
 
-def hash_password(password: str, salt: Optional[str] = None) -> str:
-    if salt is None:
-        salt = secrets.token_hex(16)
-    h = hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
-    return f"{salt}${h}"
+_password_hasher = PasswordHasher(time_cost=3, memory_cost=64 * 1024, parallelism=2)
+# Verified against for unknown emails so they cost the same as a real check
+_DUMMY_PASSWORD_HASH = _password_hasher.hash(secrets.token_urlsafe(16))
+
+
+def hash_password(password: str) -> str:
+    # Argon2id output embeds the salt and cost parameters
+    return _password_hasher.hash(password)
 
 
 def verify_password(password: str, stored_hash: str) -> bool:
+    if stored_hash.startswith("$argon2"):
+        try:
+            return _password_hasher.verify(stored_hash, password)
+        except (VerifyMismatchError, VerificationError, InvalidHashError):
+            return False
+    # Legacy "salt$sha256" hashes created before the Argon2 migration
     try:
         salt, _hash = stored_hash.split("$")
     except ValueError:
         return False
-    return hash_password(password, salt) == stored_hash
+    digest = hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
+    # Bytes, since compare_digest rejects non-ASCII str from malformed hashes
+    return hmac.compare_digest(digest.encode("utf-8"), _hash.encode("utf-8"))
+
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    if not stored_hash.startswith("$argon2"):
+        return True
+    try:
+        return _password_hasher.check_needs_rehash(stored_hash)
+    except InvalidHashError:
+        return True
+
+
+def duplicate_key_field(e: DuplicateKeyError) -> Optional[str]:
+    details = e.details or {}
+    if details.get("keyPattern"):
+        return next(iter(details["keyPattern"]))
+    # Older servers only name the index in the message, e.g. "index: username_1"
+    errmsg = details.get("errmsg") or str(e)
+    for field in ("username", "email"):
+        if f"{field}_1" in errmsg:
+            return field
+    return None
+
+
+# token -> serialized user; per process, so a logout elsewhere takes up to
+# TOKEN_CACHE_TTL seconds to apply
+TOKEN_CACHE_TTL = 60
+_token_cache = TTLCache(maxsize=50_000, ttl=TOKEN_CACHE_TTL)
+# user _id -> tokens cached for that user, so eviction needn't scan _token_cache
+_user_tokens = TTLCache(maxsize=100_000, ttl=TOKEN_CACHE_TTL)
+# Bumped on every eviction; a lookup that overlapped one must not be cached,
+# or it could re-cache a token that was just revoked
+_cache_generation = 0
+
+
+def cache_user(token: str, user: dict):
+    _token_cache[token] = user
+    tokens = {t for t in _user_tokens.get(user["_id"], ()) if t in _token_cache}
+    tokens.add(token)
+    # Re-set on every add so the entry outlives each token it lists
+    _user_tokens[user["_id"]] = tokens
+
+
+def evict_cached_token(token: str):
+    global _cache_generation
+    _cache_generation += 1
+    _token_cache.pop(token, None)
+
 
+def evict_cached_user(user_id: str):
+    global _cache_generation
+    _cache_generation += 1
+    for token in _user_tokens.pop(user_id, ()):
+        _token_cache.pop(token, None)
 
-def require_auth(authorization: Optional[str] = Header(default=None)):
+
+@dataclass(frozen=True)
+class AuthCtx:
+    user: dict
+    token: str
+
+
+async def require_auth(authorization: Optional[str] = Header(default=None)) -> AuthCtx:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Unauthorized")
     token = authorization.split(" ", 1)[1]
-    user = db["user"].find_one({"active_tokens": token})
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return AuthCtx(user=cached, token=token)
+    generation = _cache_generation
+    session = await run_in_threadpool(db["session"].find_one, {"token": token}, {"user_id": 1})
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = await run_in_threadpool(db["user"].find_one, {"_id": session["user_id"]}, {"username": 1, "email": 1})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid token")
+    user["_oid"] = user["_id"]  # native ObjectId for follow-up queries
     user["_id"] = str(user["_id"])  # serialize
-    return user
+    if generation == _cache_generation:
+        cache_user(token, user)
+    return AuthCtx(user=user, token=token)
 
 
 # ------------------------
 # Schemas (requests/responses)
 # ------------------------
 
+# Stripping is applied per field so passwords are left untouched
+Username = Annotated[str, StringConstraints(strip_whitespace=True, min_length=3, max_length=32)]
+
+
 class RegisterRequest(BaseModel):
-    username: str = Field(..., min_length=3, max_length=32)
+    username: Username
     email: EmailStr
     password: str = Field(..., min_length=6)
 
@@ -74,11 +248,13 @@ class ProfileOut(BaseModel):
 
 
 class UpdateProfileRequest(BaseModel):
-    username: Optional[str] = Field(None, min_length=3, max_length=32)
+    username: Optional[Username] = None
     email: Optional[EmailStr] = None
 
 
 class CreateKeyRequest(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
     username: Optional[str] = None  # label input as described
 
 
@@ -95,32 +271,41 @@ class ApiKeyOut(BaseModel):
 # ------------------------
 
 @app.post("/auth/register")
-def register(payload: RegisterRequest):
-    # Unique email and username check
-    if db["user"].find_one({"$or": [{"email": payload.email}, {"username": payload.username}] } ):
-        raise HTTPException(status_code=400, detail="Username or email already exists")
-
-    password_hash = hash_password(payload.password)
+async def register(payload: RegisterRequest):
+    require_unique_indexes()
+    password_hash = await run_in_threadpool(hash_password, payload.password)
+    now = datetime.now(timezone.utc)
     user_doc = {
         "username": payload.username,
         "email": str(payload.email),
         "password_hash": password_hash,
-        "active_tokens": [],
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
+        "created_at": now,
+        "updated_at": now,
     }
-    res = db["user"].insert_one(user_doc)
+    # Uniqueness of email and username is enforced by the indexes
+    try:
+        res = await run_in_threadpool(db["user"].insert_one, user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username or email already exists")
     user_id = str(res.inserted_id)
     return {"ok": True, "user": {"id": user_id, "username": payload.username, "email": str(payload.email)}}
 
 
 @app.post("/auth/login")
-def login(payload: LoginRequest):
-    user = db["user"].find_one({"email": str(payload.email)})
-    if not user or not verify_password(payload.password, user.get("password_hash", "")):
+async def login(payload: LoginRequest):
+    user = await run_in_threadpool(db["user"].find_one, {"email": str(payload.email)}, {"username": 1, "email": 1, "password_hash": 1})
+    stored_hash = user.get("password_hash", "") if user else _DUMMY_PASSWORD_HASH
+    verified = await run_in_threadpool(verify_password, payload.password, stored_hash)
+    if not user or not verified:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    now = datetime.now(timezone.utc)
+    if password_needs_rehash(stored_hash):
+        # Upgrade legacy or outdated hashes while the plaintext is at hand
+        new_hash = await run_in_threadpool(hash_password, payload.password)
+        await run_in_threadpool(db["user"].update_one, {"_id": user["_id"]}, {"$set": {"password_hash": new_hash, "updated_at": now}})
     token = secrets.token_urlsafe(32)
-    db["user"].update_one({"_id": user["_id"]}, {"$push": {"active_tokens": token}, "$set": {"updated_at": datetime.now(timezone.utc)}})
+    session_doc = {"token": token, "user_id": user["_id"], "created_at": now}
+    await run_in_threadpool(db["session"].insert_one, session_doc)
     return {
         "ok": True,
         "token": token,
@@ -129,37 +314,53 @@ def login(payload: LoginRequest):
 
 
 @app.post("/auth/logout")
-def logout(user=Depends(require_auth), authorization: Optional[str] = Header(default=None)):
-    token = authorization.split(" ", 1)[1]
-    db["user"].update_one({"_id": ObjectId(user["_id"])}, {"$pull": {"active_tokens": token}})
+async def logout(auth: AuthCtx = Depends(require_auth)):
+    await run_in_threadpool(db["session"].delete_one, {"token": auth.token})
+    evict_cached_token(auth.token)
     return {"ok": True}
 
 
+@app.post("/auth/logout-all")
+async def logout_all(auth: AuthCtx = Depends(require_auth)):
+    # One delete_many revokes every session instead of a write per token
+    res = await run_in_threadpool(db["session"].delete_many, {"user_id": auth.user["_oid"]})
+    # Only this worker's token cache is cleared; other workers keep accepting
+    # the revoked tokens until their cached entries expire (TOKEN_CACHE_TTL)
+    evict_cached_user(auth.user["_id"])
+    return {"ok": True, "revoked": res.deleted_count}
+
+
 # ------------------------
 # Profile & Settings
 # ------------------------
 
 @app.get("/me", response_model=ProfileOut)
-def me(user=Depends(require_auth)):
-    return {"id": user["_id"], "username": user["username"], "email": user["email"]}
+async def me(auth: AuthCtx = Depends(require_auth)):
+    return {"id": auth.user["_id"], "username": auth.user["username"], "email": auth.user["email"]}
 
 
 @app.patch("/me")
-def update_me(payload: UpdateProfileRequest, user=Depends(require_auth)):
+async def update_me(payload: UpdateProfileRequest, auth: AuthCtx = Depends(require_auth)):
+    require_unique_indexes()
     updates = {}
+    # Always write submitted values: auth.user may be a stale cached snapshot
     if payload.username:
-        # Check uniqueness
-        if db["user"].find_one({"username": payload.username, "_id": {"$ne": ObjectId(user["_id"])}}):
-            raise HTTPException(status_code=400, detail="Username already taken")
         updates["username"] = payload.username
     if payload.email:
-        if db["user"].find_one({"email": str(payload.email), "_id": {"$ne": ObjectId(user["_id"])}}):
-            raise HTTPException(status_code=400, detail="Email already taken")
         updates["email"] = str(payload.email)
     if not updates:
         return {"ok": True}
     updates["updated_at"] = datetime.now(timezone.utc)
-    db["user"].update_one({"_id": ObjectId(user["_id"])}, {"$set": updates})
+    try:
+        await run_in_threadpool(db["user"].update_one, {"_id": auth.user["_oid"]}, {"$set": updates})
+    except DuplicateKeyError as e:
+        field = duplicate_key_field(e)
+        if field == "username":
+            raise HTTPException(status_code=400, detail="Username already taken")
+        if field == "email":
+            raise HTTPException(status_code=400, detail="Email already taken")
+        raise HTTPException(status_code=400, detail="Username or email already taken")
+    evict_cached_user(auth.user["_id"])
     return {"ok": True}
 
 
@@ -168,56 +369,112 @@ def update_me(payload: UpdateProfileRequest, user=Depends(require_auth)):
 # ------------------------
 
 @app.get("/api-keys", response_model=List[ApiKeyOut])
-def list_api_keys(user=Depends(require_auth)):
-    keys = db["apikey"].find({"user_id": user["_id"]}).sort("created_at", -1)
-    results = []
-    for k in keys:
-        results.append({
-            "id": str(k["_id"]),
-            "label": k.get("label"),
-            "key": k["key"],
-            "usage_count": k.get("usage_count", 0),
-            "created_at": k.get("created_at", datetime.now(timezone.utc)),
-        })
-    return results
+async def list_api_keys(auth: AuthCtx = Depends(require_auth)):
+    now = datetime.now(timezone.utc)
+
+    def fetch_keys():
+        # Serialize while draining the cursor instead of copying it to a list first
+        keys = db["apikey"].find({"user_id": auth.user["_id"]}, {"label": 1, "key": 1, "usage_count": 1, "created_at": 1}).sort("created_at", -1)
+        return [
+            {
+                "id": str(k["_id"]),
+                "label": k.get("label"),
+                "key": k["key"],
+                "usage_count": k.get("usage_count", 0),
+                "created_at": k.get("created_at", now),
+            }
+            for k in keys
+        ]
+
+    return await run_in_threadpool(fetch_keys)
 
 
 @app.post("/api-keys/create")
-def create_api_key(payload: CreateKeyRequest, user=Depends(require_auth)):
+async def create_api_key(payload: CreateKeyRequest, auth: AuthCtx = Depends(require_auth)):
     # Generate random API key
     api_key = "nex_" + secrets.token_urlsafe(24)
+    now = datetime.now(timezone.utc)
     doc = {
-        "user_id": user["_id"],
-        "label": payload.username or user["username"],
+        "user_id": auth.user["_id"],
+        "label": payload.username or auth.user["username"],
         "key": api_key,
         "usage_count": 0,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
+        "created_at": now,
+        "updated_at": now,
     }
-    res_id = db["apikey"].insert_one(doc).inserted_id
+    res_id = (await run_in_threadpool(db["apikey"].insert_one, doc)).inserted_id
     return {"ok": True, "key": api_key, "id": str(res_id)}
 
 
+# Usage counters are buffered per process and written in one bulk_write per
+# interval, so usage_count may lag real traffic by up to USAGE_FLUSH_INTERVAL.
+USAGE_FLUSH_INTERVAL = 1.0
+_key_cache = TTLCache(maxsize=100_000, ttl=300)  # key -> apikey _id
+_pending_usage = Counter()  # apikey _id -> unflushed hits
+_flush_lock = asyncio.Lock()  # one flush at a time (periodic vs. shutdown)
+
+
+def write_usage(counts: list):
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne({"_id": key_id}, {"$inc": {"usage_count": n}, "$set": {"updated_at": now}})
+        for key_id, n in counts
+    ]
+    db["apikey"].bulk_write(ops, ordered=False)
+
+
+async def flush_usage():
+    global _pending_usage
+    async with _flush_lock:
+        if not _pending_usage:
+            return
+        counts, _pending_usage = list(_pending_usage.items()), Counter()
+        try:
+            await run_in_threadpool(write_usage, counts)
+        except BulkWriteError as e:
+            # Unordered: every op without a write error was applied, so only the
+            # failed ones go back for the next flush
+            for error in e.details.get("writeErrors", []):
+                key_id, n = counts[error["index"]]
+                _pending_usage[key_id] += n
+        except Exception:
+            _pending_usage.update(dict(counts))  # nothing written; retry on the next flush
+
+
+async def flush_usage_until(stop: asyncio.Event):
+    # Stopped via the event rather than cancel(), which would abandon an
+    # in-flight write whose counts were already taken out of _pending_usage
+    while not stop.is_set():
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), timeout=USAGE_FLUSH_INTERVAL)
+        await flush_usage()
+    # Hits buffered while the last write was in flight
+    await flush_usage()
+
+
 # Public endpoint to simulate API usage with provided key
 @app.post("/use")
-def use_api(key: str):
-    doc = db["apikey"].find_one({"key": key})
-    if not doc:
-        raise HTTPException(status_code=404, detail="API key not found")
-    db["apikey"].update_one({"_id": doc["_id"]}, {"$inc": {"usage_count": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}})
+async def use_api(key: str):
+    key_id = _key_cache.get(key)
+    if key_id is None:
+        doc = await run_in_threadpool(db["apikey"].find_one, {"key": key}, {"_id": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail="API key not found")
+        key_id = _key_cache[key] = doc["_id"]
+    _pending_usage[key_id] += 1
     return {"ok": True}
 
 
 @app.get("/stats")
-def stats(user=Depends(require_auth)):
-    total_keys = db["apikey"].count_documents({"user_id": user["_id"]})
+async def stats(auth: AuthCtx = Depends(require_auth)):
     pipeline = [
-        {"$match": {"user_id": user["_id"]}},
-        {"$group": {"_id": None, "total": {"$sum": "$usage_count"}}}
+        {"$match": {"user_id": auth.user["_id"]}},
+        {"$group": {"_id": None, "total_keys": {"$sum": 1}, "total_usage": {"$sum": "$usage_count"}}}
     ]
-    agg = list(db["apikey"].aggregate(pipeline))
-    total_usage = agg[0]["total"] if agg else 0
-    return {"total_keys": total_keys, "total_usage": total_usage}
+    agg = await run_in_threadpool(lambda: list(db["apikey"].aggregate(pipeline)))
+    if not agg:
+        return {"total_keys": 0, "total_usage": 0}
+    return {"total_keys": agg[0]["total_keys"], "total_usage": agg[0]["total_usage"]}
 
 
 @app.get("/")
@@ -225,6 +482,12 @@ def root():
     return {"name": "Nexus Explorer API", "status": "ok"}
 
 
+@ttl_cache(maxsize=1, ttl=30)
+def list_collections():
+    # listCollections is an admin command; /test is polled by health checks
+    return db.list_collection_names()
+
+
 @app.get("/test")
 def test_database():
     response = {
@@ -243,7 +506,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = list_collections()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -253,8 +516,8 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if HAS_DATABASE_URL else "❌ Not Set"
+    response["database_name"] = "✅ Set" if HAS_DATABASE_NAME else "❌ Not Set"
     return response
 
 
@@ -6,7 +6,7 @@ name is the lowercase of the class name.
 """
 
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional
 
 
 class User(BaseModel):
@@ -16,8 +16,16 @@ class User(BaseModel):
     """
     username: str = Field(..., min_length=3, max_length=32)
     email: str = Field(...)
-    password_hash: str = Field(..., description="Stored password hash with salt")
-    active_tokens: Optional[List[str]] = Field(default_factory=list)
+    password_hash: str = Field(..., description="Argon2id encoded hash (salt and parameters embedded); legacy salt$sha256 until next login")
+
+
+class Session(BaseModel):
+    """
+    Login sessions collection schema
+    Collection: "session"
+    """
+    token: str = Field(..., description="Bearer token issued at login")
+    user_id: str = Field(..., description="Owner user's _id (stored as ObjectId)")
 
 
 class Apikey(BaseModel):